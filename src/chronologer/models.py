@@ -1,5 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import arviz as az
+import numpy as np
 import pymc as pm
+from pymc.initial_point import make_initial_point_fns_per_chain
 import pytensor.tensor as pt
+from .pymccarbon import interpolate_calcurve
 
 def approx_integral(rate_func, domain):
     """
@@ -95,3 +101,384 @@ def ippp_logp_lm(X_tau, Beta, domain):
 
     # Return the log-likelihood
     return log_rate_sum - integral_rate
+
+def hsgp_basis(t, domain, m, c=1.5):
+    """
+    Hilbert-space (Laplacian eigenfunction) basis for approximating a GP.
+
+    The basis is defined on [-L, L] around the centre of the domain, with
+    L = c * (half the width of the domain), following Solin & Sarkka (2020).
+
+    Parameters:
+    -----------
+    t : tensor
+        Points at which to evaluate the basis (e.g., event times or domain).
+    domain : tensor
+        The sequence of regularly-spaced points over which the process is
+        evaluated (only its endpoints are used here).
+    m : int
+        Number of basis functions.
+    c : float
+        Boundary factor; should be large enough (>= 1.2) that the process is
+        well approximated near the edges of the domain.
+
+    Returns:
+    --------
+    phi : TensorVariable
+        Basis matrix, shape (len(t), m).
+    sqrt_eigvals : TensorVariable
+        Square roots of the Laplacian eigenvalues, shape (m,).
+    """
+    center = (domain[0] + domain[-1]) / 2
+    L = c * pt.abs(domain[-1] - domain[0]) / 2
+
+    j = pt.arange(1, m + 1)
+    sqrt_eigvals = pt.pi * j / (2 * L)
+    phi = pt.sin(sqrt_eigvals[None, :] * (t[:, None] - center + L)) / pt.sqrt(L)
+
+    return phi, sqrt_eigvals
+
+def ippp_logp_hsgp(value, alpha, beta, ell, eta, domain, c=1.5, mask=None):
+    """
+    Log-likelihood function for IPPP with a log-intensity given by a
+    Gaussian Process, using a Hilbert-space basis-function approximation.
+
+    The latent log-intensity is alpha + phi(t) @ (sqrt(S) * beta), where S is
+    the spectral density of an exponentiated-quadratic kernel with length
+    scale ell and amplitude eta. Evaluating it at the event times and over the
+    domain costs O((n_events + n_domain) * m) rather than the O(n^3) of a full
+    GP, so long, finely-gridded domains remain tractable.
+
+    The basis is built here rather than with pm.gp.HSGP because HSGP centres
+    and scales its basis on the inputs it is given. The event times are
+    random variables in these models, so the basis must instead be fixed by
+    the integration domain and shared between the events and the domain.
+
+    Following Riutort-Mayol et al. (2022), choose c >= 1.2 and
+    m >= 1.75 * c * S / ell, where S is half the width of the domain and ell
+    is the smallest length scale the prior gives appreciable mass to.
+
+    Parameters:
+    -----------
+    value : tensor
+        Event times (e.g., latent calendar ages tau), shape (n_events,).
+    alpha : float
+        Mean log-intensity.
+    beta : tensor
+        Basis-function weights with standard Normal priors, shape (m,).
+        The number of basis functions is taken from its length.
+    ell : float
+        Length scale of the GP (in the same units as the domain).
+    eta : float
+        Marginal standard deviation of the GP.
+    domain : tensor
+        The sequence of regularly-spaced points over which the intensity is
+        evaluated (for integral approximation).
+    c : float
+        Boundary factor passed to hsgp_basis.
+    mask : tensor, optional
+        Vector of 0/1 values; events where mask == 0 (e.g., padding in
+        SiteModelTemplate) are left out of the log-likelihood.
+
+    Returns:
+    --------
+    TensorVariable
+        Log-likelihood of observing the event times based on the IPPP model.
+    """
+    m = beta.shape[0]
+
+    # Spectral density of the exponentiated-quadratic kernel
+    phi_tau, sqrt_eigvals = hsgp_basis(value, domain, m, c=c)
+    spd = eta**2 * pt.sqrt(2 * pt.pi) * ell * pt.exp(-0.5 * (ell * sqrt_eigvals)**2)
+    weights = pt.sqrt(spd) * beta
+
+    # Log-intensity at event times
+    log_rate_tau = alpha + pt.dot(phi_tau, weights)
+    if mask is not None:
+        log_rate_tau = pt.switch(mask > 0, log_rate_tau, 0.0)
+    log_rate_sum = pt.sum(log_rate_tau)
+
+    # Approximate the integral over the domain
+    rate_func = lambda t: pt.exp(alpha + pt.dot(hsgp_basis(t, domain, m, c=c)[0], weights))
+    integral_rate = approx_integral(rate_func, domain)
+
+    # Return the log-likelihood
+    return log_rate_sum - integral_rate
+
+# pm.NUTS options that may be passed to SiteModelTemplate.fit alongside the
+# pm.sample arguments
+NUTS_KWARGS = ("target_accept", "max_treedepth", "early_max_treedepth",
+               "step_scale", "adapt_step_size", "gamma", "k", "t0")
+
+def _pad_site(values, max_n):
+    """
+    Pads a per-date vector to length max_n by repeating its last entry.
+
+    Repeating a real entry (rather than padding with zeros) keeps the padded
+    slots numerically well-behaved; they are removed from the likelihood by
+    the mask.
+    """
+    values = np.asarray(values, dtype=float)
+    n = values.shape[0]
+    if n > max_n:
+        raise ValueError(f"Site has {n} dates but the template only holds {max_n}.")
+    if n == 0:
+        raise ValueError("Site has no dates.")
+    return np.concatenate([values, np.repeat(values[-1], max_n - n)])
+
+class SiteModelTemplate:
+    """
+    Reusable calibration (and optional process) model for fitting many sites.
+
+    The PyMC model is built once with mutable data containers holding the
+    radiocarbon ages, errors and calendar bounds for up to max_n dates. Sites
+    with fewer dates are padded and masked out of the likelihood, so the
+    compiled logp/gradient functions (including interpolate_calcurve) are
+    reused from one site to the next instead of being rebuilt for each fit.
+
+    The latent radiocarbon age is marginalised out and the measurement
+    likelihood is added as a pm.Potential rather than an observed variable.
+    The posterior is the same, but the returned InferenceData has no
+    observed_data or log_likelihood groups, so pm.sample_posterior_predictive
+    and LOO/WAIC comparisons are not available for these fits.
+
+    Parameters:
+    -----------
+    calcurve : dict
+        Calibration curve with keys 'calbp', 'c14bp' and 'c14_sigma'.
+    max_n : int
+        Largest number of dates a single site can have.
+    process_logp : callable, optional
+        Function called inside the model context as process_logp(tau, mask).
+        It should define any process-model priors and return a log-likelihood
+        term (e.g., from ippp_logp_lm) that ignores entries where mask == 0.
+        Must be a top-level function if the template is used with fit_sites
+        and more than one worker.
+    nuts_kwargs : dict, optional
+        Options passed to pm.NUTS when the step is built (e.g.,
+        target_accept, max_treedepth).
+    """
+
+    def __init__(self, calcurve, max_n, process_logp=None, nuts_kwargs=None):
+        self.max_n = int(max_n)
+        self.n = None
+        self.step = None
+        self.nuts_kwargs = dict(nuts_kwargs or {})
+        self._step_kwargs = None
+        self._logp_fn = None
+        self._initial_point_fns = {}
+
+        calbp_tensor = pt.as_tensor_variable(np.asarray(calcurve['calbp'], dtype=float))
+        c14bp_tensor = pt.as_tensor_variable(np.asarray(calcurve['c14bp'], dtype=float))
+        c14_sigma_tensor = pt.as_tensor_variable(np.asarray(calcurve['c14_sigma'], dtype=float))
+
+        # Placeholder values: a mid-curve date repeated max_n times
+        mid = float(np.median(calcurve['calbp']))
+        placeholder = np.repeat(mid, self.max_n)
+
+        coords = {"event": np.arange(self.max_n)}
+        with pm.Model(coords=coords) as self.model:
+            radiocarbon_age = pm.Data('radiocarbon_age', placeholder, dims="event")
+            radiocarbon_error = pm.Data('radiocarbon_error', np.ones(self.max_n), dims="event")
+            lower_bound = pm.Data('lower_bound', placeholder - 1, dims="event")
+            upper_bound = pm.Data('upper_bound', placeholder + 1, dims="event")
+            mask = pm.Data('mask', np.ones(self.max_n), dims="event")
+
+            tau = pm.Uniform('tau',
+                             lower=lower_bound,
+                             upper=upper_bound,
+                             dims="event")
+
+            # calibration model, with the latent radiocarbon age marginalised
+            # out so that padded dates can be masked from the likelihood
+            mean, error = interpolate_calcurve(tau,
+                                               calbp_tensor,
+                                               c14bp_tensor,
+                                               c14_sigma_tensor)
+            combined_error = pt.sqrt(error**2 + radiocarbon_error**2)
+            c14_logp = pm.logp(pm.Normal.dist(mu=mean, sigma=combined_error),
+                               radiocarbon_age)
+            pm.Potential('r_measured', pt.sum(pt.switch(mask > 0, c14_logp, 0.0)))
+
+            if process_logp is not None:
+                pm.Potential('process_likelihood', process_logp(tau, mask))
+
+    def set_site(self, radiocarbon_ages, radiocarbon_errors, lower_bound, upper_bound):
+        """
+        Loads one site's data into the template without rebuilding the model.
+
+        Parameters:
+        -----------
+        radiocarbon_ages, radiocarbon_errors : array-like
+            Radiocarbon ages (negative BP convention) and their lab errors.
+        lower_bound, upper_bound : array-like
+            Calendar-age bounds for each date's prior (e.g., from calibrate).
+
+        Raises:
+        -------
+        ValueError
+            If the inputs differ in length, are empty, or hold more than
+            max_n dates.
+        """
+        lengths = [np.asarray(values).shape[0] for values in
+                   (radiocarbon_ages, radiocarbon_errors, lower_bound, upper_bound)]
+        if len(set(lengths)) != 1:
+            raise ValueError(f"Site inputs must all have the same length, got {lengths}.")
+        n = lengths[0]
+        pm.set_data({
+            'radiocarbon_age': _pad_site(radiocarbon_ages, self.max_n),
+            'radiocarbon_error': _pad_site(radiocarbon_errors, self.max_n),
+            'lower_bound': _pad_site(lower_bound, self.max_n),
+            'upper_bound': _pad_site(upper_bound, self.max_n),
+            'mask': (np.arange(self.max_n) < n).astype(float),
+        }, model=self.model)
+        self.n = n
+
+    def fit(self, radiocarbon_ages, radiocarbon_errors, lower_bound, upper_bound, **sample_kwargs):
+        """
+        Loads a site into the template and samples its posterior.
+
+        The NUTS step (and so the compiled logp/gradient function) is created
+        on the first call and reused afterwards. NUTS options (see NUTS_KWARGS,
+        or a dict under 'nuts' as in pm.sample) are combined with the
+        template's nuts_kwargs; changing them between calls rebuilds the step.
+        Other keyword arguments are passed to pm.sample; cores defaults to 1
+        so that chains are run in this process rather than re-linking the
+        compiled step in child processes for every site.
+
+        Because the step is supplied to pm.sample, its init argument is
+        ignored. Each chain instead starts from the initial point plus a
+        uniform jitter in [-1, 1] on the transformed scale, as with PyMC's
+        default 'jitter+adapt_diag', and the mass matrix is adapted by the
+        step during tuning.
+
+        Returns:
+        --------
+        InferenceData
+            Posterior for the site, with padded dates dropped. If
+            return_inferencedata=False is passed, the MultiTrace from
+            pm.sample is returned unchanged, padding included.
+        """
+        self.set_site(radiocarbon_ages, radiocarbon_errors, lower_bound, upper_bound)
+
+        step_kwargs = dict(self.nuts_kwargs)
+        step_kwargs.update(sample_kwargs.pop('nuts', {}))
+        for key in NUTS_KWARGS:
+            if key in sample_kwargs:
+                step_kwargs[key] = sample_kwargs.pop(key)
+        if self.step is None or step_kwargs != self._step_kwargs:
+            self.step = pm.NUTS(model=self.model, **step_kwargs)
+            self._step_kwargs = step_kwargs
+
+        sample_kwargs.setdefault('cores', 1)
+        sample_kwargs.pop('init', None)
+        if 'chains' not in sample_kwargs or sample_kwargs['chains'] is None:
+            sample_kwargs['chains'] = max(2, sample_kwargs['cores'])
+        sample_kwargs['initvals'] = self._jittered_initvals(
+            sample_kwargs['chains'],
+            sample_kwargs.get('initvals'),
+            sample_kwargs.get('random_seed'),
+            sample_kwargs.pop('jitter_max_retries', 10))
+
+        trace = pm.sample(step=self.step, model=self.model, **sample_kwargs)
+        if isinstance(trace, az.InferenceData):
+            trace = trace.isel(event=slice(0, self.n))
+        return trace
+
+    def _jittered_initvals(self, chains, initvals, random_seed, jitter_max_retries):
+        """
+        Draws a jittered starting point for each chain for the current site.
+
+        The initial point functions and the logp used to reject non-finite
+        starts read the site data from the model's data containers, so they
+        are compiled once and reused across sites.
+        """
+        if initvals is not None and not isinstance(initvals, dict):
+            # Per-chain initial values were given; use them as they are
+            return initvals
+
+        if initvals is None:
+            if chains not in self._initial_point_fns:
+                self._initial_point_fns[chains] = make_initial_point_fns_per_chain(
+                    model=self.model,
+                    overrides=None,
+                    jitter_rvs=set(self.model.free_RVs),
+                    chains=chains)
+            ipfns = self._initial_point_fns[chains]
+        else:
+            ipfns = make_initial_point_fns_per_chain(
+                model=self.model,
+                overrides=initvals,
+                jitter_rvs=set(self.model.free_RVs),
+                chains=chains)
+
+        if self._logp_fn is None:
+            self._logp_fn = self.model.compile_logp()
+
+        rng = np.random.default_rng(random_seed)
+        points = []
+        for ipfn in ipfns:
+            for _ in range(jitter_max_retries + 1):
+                point = ipfn(rng.integers(2**30))
+                if np.isfinite(self._logp_fn(point)):
+                    break
+            points.append(point)
+        return points
+
+_worker_template = None
+
+def _init_worker(calcurve, max_n, process_logp):
+    global _worker_template
+    _worker_template = SiteModelTemplate(calcurve, max_n, process_logp=process_logp)
+
+def _fit_site(template, site, sample_kwargs):
+    return template.fit(site['radiocarbon_ages'],
+                        site['radiocarbon_errors'],
+                        site['lower_bound'],
+                        site['upper_bound'],
+                        **sample_kwargs)
+
+def _fit_worker(site, sample_kwargs):
+    return _fit_site(_worker_template, site, sample_kwargs)
+
+def fit_sites(sites, calcurve, max_n=None, process_logp=None, max_workers=None, **sample_kwargs):
+    """
+    Fits the same model structure to many sites, compiling it once per process.
+
+    Parameters:
+    -----------
+    sites : list of dict
+        One dict per site with keys 'radiocarbon_ages', 'radiocarbon_errors',
+        'lower_bound' and 'upper_bound'.
+    calcurve : dict
+        Calibration curve with keys 'calbp', 'c14bp' and 'c14_sigma'.
+    max_n : int, optional
+        Template size; defaults to the largest site.
+    process_logp : callable, optional
+        Process model passed to SiteModelTemplate.
+    max_workers : int, optional
+        Number of worker processes. If None or 1, sites are fitted in the
+        current process. Each worker builds its own template once.
+    **sample_kwargs :
+        Passed to SiteModelTemplate.fit (and on to pm.sample), where cores
+        defaults to 1 so that chains run inside each process.
+
+    Returns:
+    --------
+    list of InferenceData
+        One posterior per site, in the same order as sites.
+    """
+    if not sites:
+        return []
+
+    if max_n is None:
+        max_n = max(len(site['radiocarbon_ages']) for site in sites)
+
+    if max_workers is None or max_workers == 1:
+        template = SiteModelTemplate(calcurve, max_n, process_logp=process_logp)
+        return [_fit_site(template, site, sample_kwargs) for site in sites]
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker,
+                             initargs=(calcurve, max_n, process_logp)) as executor:
+        return list(executor.map(_fit_worker, sites, [sample_kwargs] * len(sites)))
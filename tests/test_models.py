@@ -0,0 +1,231 @@
+import numpy as np
+import pymc as pm
+import pytensor.tensor as pt
+import pytest
+
+from chronologer.models import (SiteModelTemplate, _pad_site, fit_sites,
+                                hsgp_basis, ippp_logp_hsgp)
+
+SAMPLE_KWARGS = dict(draws=20, tune=20, chains=1, progressbar=False,
+                     compute_convergence_checks=False, random_seed=1)
+
+SITES = [
+    {"radiocarbon_ages": [-2700.0, -2250.0],
+     "radiocarbon_errors": [30.0, 30.0],
+     "lower_bound": [-3200.0, -2700.0],
+     "upper_bound": [-2800.0, -2300.0]},
+    {"radiocarbon_ages": [-2000.0],
+     "radiocarbon_errors": [25.0],
+     "lower_bound": [-2500.0],
+     "upper_bound": [-2000.0]},
+    {"radiocarbon_ages": [-2700.0, -2250.0, -2000.0],
+     "radiocarbon_errors": [30.0, 30.0, 25.0],
+     "lower_bound": [-3200.0, -2700.0, -2500.0],
+     "upper_bound": [-2800.0, -2300.0, -2000.0]},
+]
+
+
+def constant_ippp(tau, mask):
+    # Constant-rate IPPP over a 2000-year window, ignoring padded events
+    a = pm.Normal("a", mu=-5.0, sigma=1.0)
+    return pt.sum(pt.switch(mask > 0, a, 0.0)) - pt.exp(a) * 2000.0
+
+
+@pytest.fixture
+def calcurve():
+    calbp = np.arange(-5000.0, -1000.0, 5.0)
+    return {
+        "calbp": calbp,
+        "c14bp": 0.9 * calbp,
+        "c14_sigma": np.full(calbp.shape, 15.0),
+    }
+
+
+def hsgp_process(tau, mask):
+    alpha = pm.Normal("alpha", mu=-3.0, sigma=2.0)
+    ell = pm.InverseGamma("ell", alpha=5.0, beta=1000.0)
+    eta = pm.HalfNormal("eta", sigma=1.0)
+    beta = pm.Normal("beta", mu=0.0, sigma=1.0, shape=10)
+    domain = pt.linspace(-3500.0, -1500.0, 200)
+    return ippp_logp_hsgp(tau, alpha, beta, ell, eta, domain, mask=mask)
+
+
+def test_pad_site_repeats_last_value():
+    padded = _pad_site([1.0, 2.0], 4)
+    np.testing.assert_array_equal(padded, [1.0, 2.0, 2.0, 2.0])
+
+
+def test_pad_site_rejects_empty_site():
+    with pytest.raises(ValueError):
+        _pad_site([], 3)
+
+
+def test_pad_site_rejects_site_longer_than_max_n():
+    with pytest.raises(ValueError):
+        _pad_site([1.0, 2.0, 3.0, 4.0], 3)
+
+
+def test_set_site_masks_padding(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=5)
+    template.set_site([-2700.0, -2250.0],
+                      [30.0, 30.0],
+                      [-3200.0, -2700.0],
+                      [-2800.0, -2300.0])
+
+    assert template.n == 2
+    mask = template.model["mask"].get_value()
+    np.testing.assert_array_equal(mask, [1.0, 1.0, 0.0, 0.0, 0.0])
+
+
+def test_set_site_rejects_mismatched_lengths(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=5)
+    with pytest.raises(ValueError):
+        template.set_site([-2700.0, -2250.0],
+                          [30.0],
+                          [-3200.0, -2700.0],
+                          [-2800.0, -2300.0])
+
+
+def test_fit_reuses_compiled_step(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=3)
+    sample_kwargs = SAMPLE_KWARGS
+
+    trace = template.fit([-2700.0, -2250.0],
+                         [30.0, 30.0],
+                         [-3200.0, -2700.0],
+                         [-2800.0, -2300.0],
+                         **sample_kwargs)
+    step = template.step
+    logp_dlogp_func = step._logp_dlogp_func
+
+    second = template.fit([-2000.0],
+                          [25.0],
+                          [-2500.0],
+                          [-2000.0],
+                          **sample_kwargs)
+
+    assert template.step is step
+    assert template.step._logp_dlogp_func is logp_dlogp_func
+    assert trace.posterior["tau"].sizes["event"] == 2
+    assert second.posterior["tau"].sizes["event"] == 1
+    tau = second.posterior["tau"].values
+    assert np.all((tau >= -2500.0) & (tau <= -2000.0))
+
+
+def test_fit_passes_nuts_options_to_step(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=3, nuts_kwargs={"max_treedepth": 8})
+    site = SITES[0]
+    template.fit(site["radiocarbon_ages"], site["radiocarbon_errors"],
+                 site["lower_bound"], site["upper_bound"],
+                 target_accept=0.95, **SAMPLE_KWARGS)
+
+    assert template.step.max_treedepth == 8
+    assert template.step.step_adapt._target == 0.95
+
+
+def test_fit_jitters_initial_points_per_chain(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=3)
+    template.set_site([-2700.0, -2250.0],
+                      [30.0, 30.0],
+                      [-3200.0, -2700.0],
+                      [-2800.0, -2300.0])
+
+    points = template._jittered_initvals(chains=2, initvals=None,
+                                         random_seed=1, jitter_max_retries=10)
+
+    assert len(points) == 2
+    assert not np.allclose(points[0]["tau_interval__"], points[1]["tau_interval__"])
+
+
+def test_fit_returns_multitrace_unsliced(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=3)
+    site = SITES[1]
+    trace = template.fit(site["radiocarbon_ages"], site["radiocarbon_errors"],
+                         site["lower_bound"], site["upper_bound"],
+                         return_inferencedata=False, **SAMPLE_KWARGS)
+
+    assert trace.get_values("tau").shape[-1] == 3
+
+
+def test_fit_sites_empty(calcurve):
+    assert fit_sites([], calcurve) == []
+
+
+@pytest.mark.parametrize("max_workers", [None, 2])
+def test_fit_sites_preserves_order(calcurve, max_workers):
+    traces = fit_sites(SITES, calcurve, process_logp=constant_ippp,
+                       max_workers=max_workers, **SAMPLE_KWARGS)
+
+    assert len(traces) == len(SITES)
+    for site, trace in zip(SITES, traces):
+        tau = trace.posterior["tau"]
+        assert tau.sizes["event"] == len(site["radiocarbon_ages"])
+        assert np.all(tau.values >= np.array(site["lower_bound"]))
+        assert np.all(tau.values <= np.array(site["upper_bound"]))
+        assert "a" in trace.posterior
+
+
+def test_hsgp_basis_approximates_expquad_kernel():
+    x = np.linspace(0.0, 10.0, 25)
+    ell, eta = 2.0, 1.5
+
+    phi, sqrt_eigvals = hsgp_basis(pt.as_tensor_variable(x),
+                                   pt.as_tensor_variable(x),
+                                   m=40, c=2.0)
+    phi, sqrt_eigvals = phi.eval(), sqrt_eigvals.eval()
+    spd = eta**2 * np.sqrt(2 * np.pi) * ell * np.exp(-0.5 * (ell * sqrt_eigvals)**2)
+
+    approx = phi @ np.diag(spd) @ phi.T
+    exact = eta**2 * np.exp(-0.5 * (x[:, None] - x[None, :])**2 / ell**2)
+    np.testing.assert_allclose(approx, exact, atol=1e-4)
+
+
+def _hsgp_logp(value, mask=None):
+    domain = pt.linspace(-3000.0, -2000.0, 200)
+    beta = pt.as_tensor_variable(np.array([0.5, -1.0, 0.3, 0.8, -0.2]))
+    logp = ippp_logp_hsgp(pt.as_tensor_variable(np.asarray(value)),
+                          alpha=-3.0, beta=beta, ell=150.0, eta=1.0,
+                          domain=domain, mask=mask)
+    return logp.eval()
+
+
+def test_ippp_logp_hsgp_mask():
+    value = np.array([-2800.0, -2500.0, -2100.0])
+
+    unmasked = _hsgp_logp(value)
+    all_ones = _hsgp_logp(value, mask=pt.as_tensor_variable(np.ones(3)))
+    np.testing.assert_allclose(all_ones, unmasked)
+
+    masked = _hsgp_logp(value, mask=pt.as_tensor_variable(np.array([1.0, 1.0, 0.0])))
+    np.testing.assert_allclose(masked, _hsgp_logp(value[:2]))
+    assert not np.isclose(masked, unmasked)
+
+
+def test_ippp_logp_hsgp_gradient_in_model():
+    domain = pt.linspace(-3500.0, -1500.0, 200)
+    m = 15
+
+    with pm.Model() as model:
+        tau = pm.Uniform("tau", lower=-3200.0, upper=-1800.0, shape=5)
+        alpha = pm.Normal("alpha", mu=-3.0, sigma=2.0)
+        ell = pm.InverseGamma("ell", alpha=5.0, beta=1000.0)
+        eta = pm.HalfNormal("eta", sigma=1.0)
+        beta = pm.Normal("beta", mu=0.0, sigma=1.0, shape=m)
+        pm.Potential("ippp_likelihood",
+                     ippp_logp_hsgp(tau, alpha, beta, ell, eta, domain, c=1.5))
+
+    point = model.initial_point()
+    assert np.isfinite(model.compile_logp()(point))
+    assert np.all(np.isfinite(model.compile_dlogp()(point)))
+
+
+def test_ippp_logp_hsgp_as_template_process(calcurve):
+    template = SiteModelTemplate(calcurve, max_n=4, process_logp=hsgp_process)
+    template.set_site([-2700.0, -2250.0],
+                      [30.0, 30.0],
+                      [-3200.0, -2700.0],
+                      [-2800.0, -2300.0])
+
+    point = template.model.initial_point()
+    assert np.isfinite(template.model.compile_logp()(point))
+    assert np.all(np.isfinite(template.model.compile_dlogp()(point)))